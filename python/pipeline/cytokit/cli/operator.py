@@ -1,20 +1,24 @@
 import fire
 import os
 import os.path as osp
+import threading
 import numpy as np
-import pandas as pd
 from cytokit import config as cytokit_config
 from cytokit.ops import cytometry
 from cytokit.ops import tile_generator
 from cytokit.ops import tile_crop
 from cytokit.utils import ij_utils
+from cytokit.utils import np_utils
 from cytokit import io as cytokit_io
 from cytokit import cli
 from cytokit.function import core
 from cytokit.function import data as function_data
 from cytokit.cli import CH_SRC_RAW, CH_SRC_PROC, CH_SRC_CYTO, CH_SOURCES
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
+MAX_EXTRACT_WORKERS = 8
+
 PATH_FMT_MAP = {
     CH_SRC_RAW: None,
     CH_SRC_PROC: cytokit_io.FMT_PROC_IMAGE,
@@ -22,16 +26,27 @@ PATH_FMT_MAP = {
 }
 
 
+CH_SOURCE_SET = frozenset(CH_SOURCES)
+
+
 def _get_channel_source(channel):
-    res = None
-    for src in CH_SOURCES:
-        if channel.startswith(src + '_'):
-            res = src
-    return res
+    """Get source for channel name prefixed like "<source>_<name>" or None if prefix is not a valid source"""
+    src, sep, _ = channel.partition('_')
+    return src if sep and src in CH_SOURCE_SET else None
 
 
 def _map_channels(config, channels):
-    res = []
+    """Resolve prefixed channel names to source-specific cycle and channel coordinates
+
+    Returns:
+        Dictionary keyed by source with values as (cycle_indexes, channel_indexes, channel_names) where indexes
+        are integer arrays and all three are sorted by channel name (to make extract channel order deterministic)
+    """
+    # Build name -> coordinate lookups once rather than resolving each channel against the full channel list
+    config_coord_map = config.get_channel_coordinates_map()
+    cyto_coord_map = cytometry.get_channel_coordinates_map()
+
+    res = {}
     for channel in channels:
         src = _get_channel_source(channel)
         if src is None:
@@ -39,16 +54,28 @@ def _map_channels(config, channels):
                 'Channel with name "{}" is not valid.  Must start with one of the following: {}'
                 .format(channel, [c + '_' for c in CH_SOURCES])
             )
-        channel = '_'.join(channel.split('_')[1:])
+        channel = channel.split('_', 1)[1]
         if src == CH_SRC_RAW or src == CH_SRC_PROC:
-            coords = config.get_channel_coordinates(channel)
-            res.append([channel, src, coords[0], coords[1]])
+            coord_map, coord_fn = config_coord_map, config.get_channel_coordinates
         elif src == CH_SRC_CYTO:
-            coords = cytometry.get_channel_coordinates(channel)
-            res.append([channel, src, coords[0], coords[1]])
+            coord_map, coord_fn = cyto_coord_map, cytometry.get_channel_coordinates
         else:
             raise AssertionError('Source "{}" is invalid'.format(src))
-    return pd.DataFrame(res, columns=['channel_name', 'source', 'cycle_index', 'channel_index'])
+        # Fall back on single channel lookups for names not found, which also raise the appropriate errors
+        coords = coord_map.get(channel.lower())
+        if coords is None:
+            coords = coord_fn(channel)
+        res.setdefault(src, []).append((channel, int(coords[0]), int(coords[1])))
+
+    channel_map = {}
+    for src, rows in res.items():
+        rows = sorted(rows, key=lambda r: r[0])
+        channel_map[src] = (
+            np.asarray([r[1] for r in rows], dtype=np.intp),
+            np.asarray([r[2] for r in rows], dtype=np.intp),
+            [r[0] for r in rows]
+        )
+    return channel_map
 
 
 def _get_z_slice_fn(z, data_dir):
@@ -64,15 +91,19 @@ def _get_z_slice_fn(z, data_dir):
         data_dir: Data directory necessary to infer 'best' z planes
     Returns:
         A function with signature (region_index, tile_x, tile_y) -> slice_for_array where slice_for_array
-        will either be a slice instance or a list of z-indexes (Note: all indexes are 0-based)
+        will either be a slice instance or a list/array of z-indexes (Note: all indexes are 0-based)
     """
     if not z:
         raise ValueError('Z slice cannot be defined as empty value (given = {})'.format(z))
 
     # Look for keyword strings
     if isinstance(z, str) and z == 'best':
-        map = function_data.get_best_focus_coord_map(data_dir)
-        return lambda ri, tx, ty: [map[(ri, tx, ty)]]
+        # Convert best z planes to read-only index arrays once rather than allocating a new list for every tile
+        map = {}
+        for k, v in function_data.get_best_focus_coord_map(data_dir).items():
+            map[k] = np.array([v], dtype=np.intp)
+            map[k].flags.writeable = False
+        return lambda ri, tx, ty: map[(ri, tx, ty)]
     if isinstance(z, str) and z == 'all':
         return lambda ri, tx, ty: slice(None)
 
@@ -81,6 +112,41 @@ def _get_z_slice_fn(z, data_dir):
     return lambda ri, tx, ty: zi
 
 
+def _get_z_indexes(z_slice, n_z):
+    """Convert result of z slice function to integer index array for volumes with `n_z` planes"""
+    if isinstance(z_slice, slice):
+        return np.arange(n_z)[z_slice]
+    return np.asarray(z_slice, dtype=np.intp)
+
+
+def _copy_channels(tile, cycles, z_idx, chans, out, dtype=None):
+    """Copy volumes for (cycle, channel) coordinates in a 5D tile into an array with shape (z, channels, h, w)
+
+    Planes are copied one at a time using basic indexing so that each is written directly into `out`
+    without any intermediate gathered or transposed arrays.  Copies are made in the storage order of
+    `out` (z-major, then channel), so writes to it are sequential.
+
+    Args:
+        tile: 5D tile with shape (cycles, z, channels, h, w)
+        cycles: Cycle index for each channel to copy
+        z_idx: Z plane indexes to copy
+        chans: Per-cycle channel index for each channel to copy (same length as `cycles`)
+        out: Array with shape (len(z_idx), len(chans), h, w) to write to
+        dtype: Optional unsigned integer type to round and clip planes to before writing
+    """
+    # Index with python ints rather than numpy scalars, which numpy handles through a slower path
+    coords = [(int(cyc), int(ch)) for cyc, ch in zip(cycles, chans)]
+    for j, z in enumerate(z_idx):
+        z = int(z)
+        for i, (cyc, ch) in enumerate(coords):
+            plane = tile[cyc, z, ch]
+            if dtype is not None:
+                if np.issubdtype(plane.dtype, np.floating):
+                    plane = np.rint(plane)
+                plane = np_utils.arr_to_uint(plane, dtype)
+            out[j, i] = plane
+
+
 def _get_tile_locations(config, region_indexes, tile_indexes):
     res = []
     for tile_location in config.get_tile_indices():
@@ -97,7 +163,104 @@ class Operator(cli.DataCLI):
     def _get_function_configs(self):
         return self.config.operator_params
 
-    def extract(self, name, channels, z='best', region_indexes=None, tile_indexes=None, raw_dir=None):
+    def _extract_tile(self, loc, extract_path, channel_map, channel_sources, z_slice_fn, raw_dir,
+                      crop_slice=None, dtype=None):
+        """Extract and save the requested channels for a single tile location to `extract_path`
+
+        Note that the directory containing `extract_path` must already exist.
+        """
+        # Labels are known up front since channel order is fixed by the channel map
+        slice_labels = [
+            '{}_{}'.format(src, ch_name)
+            for src in channel_sources
+            for ch_name in channel_map[src][2]
+        ]
+
+        def create_extract_tile(shape, dtype):
+            logging.debug('Creating tile with shape %s (dtype = %s) at "%s"', shape, dtype, tmp_path)
+            # Construct slice labels as repeats across z-dimension (there is only one time/cycle dimension)
+            slice_label_tags = ij_utils.get_channel_label_tags(slice_labels, z=shape[1], t=1)
+            return cytokit_io.create_tile_memmap(
+                tmp_path, shape, dtype, config=self.config,
+                infer_labels=False, extratags=slice_label_tags, skip_mkdir=True
+            )
+
+        # Assemble the result in a temporary file next to the final one and only move it into place once all
+        # sources are written, so that a failure never leaves a partially extracted tile behind
+        tmp_path = osp.join(osp.dirname(extract_path), '.tmp.' + osp.basename(extract_path))
+        try:
+            # Output tile with shape (cycles, z, channels, h, w) mapped directly to the temporary result file
+            # and created once the z/h/w dimensions are known
+            extract_tile = None
+            ch_idx = 0
+
+            # Resolve z-slices to crop from extracted volumes once since they are shared by all channels in the tile
+            z_slice = z_slice_fn(loc.region_index, loc.tile_x, loc.tile_y)
+
+            for src in channel_sources:
+
+                # Initialize tile generator for this data source (which are all the same except
+                # for when using raw data, which does not have pre-assembled tiles available)
+                tile_gen_dir = self.data_dir
+                tile_gen_mode = 'stack'
+                if src == CH_SRC_RAW:
+                    tile_gen_dir = raw_dir
+                    tile_gen_mode = 'raw'
+                generator = tile_generator.CytokitTileGenerator(
+                    self.config, tile_gen_dir, loc.region_index, loc.tile_index,
+                    mode=tile_gen_mode, path_fmt_name=PATH_FMT_MAP[src]
+                )
+                tile = generator.run(None)
+
+                # Crop raw images if necessary; this results in a view of the raw tile so that cropping and channel
+                # selection are effectively fused (only the cropped region of selected planes is copied below)
+                if src == CH_SRC_RAW:
+                    tile = tile_crop.crop(tile, self.config, crop_slice)
+
+                cycles, chans, names = channel_map[src]
+                z_idx = _get_z_indexes(z_slice, tile.shape[1])
+                tile_dtype = tile.dtype if dtype is None else dtype
+
+                # Create result once dimensions are known or re-create it with a common type (as stacking would)
+                # when sources differ in data type
+                if extract_tile is None:
+                    nh, nw = tile.shape[-2:]
+                    extract_tile = create_extract_tile((1, len(z_idx), len(slice_labels), nh, nw), tile_dtype)
+                elif not np.can_cast(tile_dtype, extract_tile.dtype):
+                    shape, promoted_dtype = extract_tile.shape, np.promote_types(extract_tile.dtype, tile_dtype)
+                    prev_tile = np.array(extract_tile[:, :, :ch_idx])
+                    del extract_tile
+                    extract_tile = create_extract_tile(shape, promoted_dtype)
+                    extract_tile[:, :, :ch_idx] = prev_tile
+                    del prev_tile
+                nz, nh, nw = extract_tile.shape[1], extract_tile.shape[3], extract_tile.shape[4]
+                assert tile.ndim == 5 and (len(z_idx),) + tile.shape[-2:] == (nz, nh, nw), \
+                    'Expecting 5D tile with {} selected z planes and image shape {} but got shape {} (z slice = {})'\
+                    .format(nz, (nh, nw), tile.shape, z_slice)
+
+                # Write the subtiles directly into their channel slots rather than stacking copies afterwards
+                n = len(names)
+                _copy_channels(tile, cycles, z_idx, chans, extract_tile[0, :, ch_idx:(ch_idx + n)], dtype=dtype)
+                logging.debug(
+                    'Extraction for cycles %s, channels %s (%s), z slice %s, source "%s" complete (tile shape = %s)',
+                    cycles, chans, names, z_slice, src, tile.shape
+                )
+                ch_idx += n
+
+                # Release the source tile before the next one is loaded since nothing copied out of it holds
+                # a reference (otherwise two full source tiles would be held at once while reading the next)
+                del tile
+
+            extract_tile.flush()
+            del extract_tile
+            os.replace(tmp_path, extract_path)
+        except BaseException:
+            if osp.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def extract(self, name, channels, z='best', region_indexes=None, tile_indexes=None, raw_dir=None,
+                n_workers=None, dtype=None, scheduler=None):
         """Create a new data extraction include either raw, processed, or cytometric imaging data
 
         Args:
@@ -108,6 +271,7 @@ class Operator(cli.DataCLI):
                 - "raw": Raw data images
                 - "proc": Data generated as a results of preprocessing
                 - "cyto": Cytometric object data (nuclei and cell boundaries)
+                Channels in the resulting images are ordered by source as listed above and then by name
             z: String or 1-based index selector for z indexes constructed as any of the following:
                 - "best": Indicates that z slices should be inferred based on focal quality (default option)
                 - "all": Indicates that a slice for all z-planes should be used
@@ -124,9 +288,30 @@ class Operator(cli.DataCLI):
                 be equivalent to the same raw directory used during processing (i.e. nearly all operations like
                 this are run relative to an `output_dir` -- the result of processing -- but in this case
                 the original raw data path is needed as well)
+            n_workers: Number of threads used to extract tiles concurrently; tiles are independent and extraction
+                is dominated by file IO so this defaults to min(8, number of tiles).  Each worker reads, slices and
+                writes one tile at a time, so with 2 or more workers the reads for some tiles overlap with the
+                slicing and writing of others (set to 1 to process tiles strictly in sequence).  Known tifffile read
+                warnings are ignored for the whole process once extraction starts since per-read warning filters
+                are not thread-safe (see `cytokit.io.set_tiff_warning_filters`)
+            dtype: Unsigned integer type name (e.g. "uint16" or "uint8") to convert extracted images to before
+                saving; values are rounded and clipped to the range of the type (no rescaling is applied).  By
+                default, images are saved with the type of the source data
+            scheduler: Name of dask scheduler (e.g. "threads", "processes", or "synchronous") to use for executing
+                tile extractions as a graph of delayed tasks with `n_workers` workers, rather than the default
+                thread pool; "processes" is useful when cropping and type conversion make extraction CPU-bound
         """
-        channel_map = _map_channels(self.config, channels).groupby('source')
-        channel_sources = sorted(list(channel_map.groups.keys()))
+        channel_map = _map_channels(self.config, channels)
+        # Process sources in canonical order (raw, proc, cyto), which also determines result channel order
+        channel_sources = [src for src in CH_SOURCES if src in channel_map]
+        if not channel_map:
+            raise ValueError('At least one channel must be specified for extraction (given = {})'.format(channels))
+        if CH_SRC_RAW in channel_sources and not raw_dir:
+            raise ValueError('When extracting raw data channels, the `raw_dir` argument must be provided')
+        if dtype is not None:
+            dtype = np.dtype(dtype)
+            if not np.issubdtype(dtype, np.unsignedinteger):
+                raise ValueError('Extract data type must be an unsigned integer type (given = {})'.format(dtype))
 
         z_slice_fn = _get_z_slice_fn(z, self.data_dir)
         region_indexes = cli.resolve_index_list_arg(region_indexes, zero_based=True)
@@ -135,71 +320,58 @@ class Operator(cli.DataCLI):
         logging.info('Creating extraction "%s"', name)
 
         tile_locations = _get_tile_locations(self.config, region_indexes, tile_indexes)
-
-        extract_path = None
-        for i, loc in enumerate(tile_locations):
-            logging.info('Extracting tile {} of {}'.format(i+1, len(tile_locations)))
-            extract_tile = []
-
-            # Create function used to crop out z-slices from extracted volumes
-            z_slice = z_slice_fn(loc.region_index, loc.tile_x, loc.tile_y)
-
-            slice_labels = []
-            for src in channel_sources:
-
-                # Initialize tile generator for this data source (which are all the same except
-                # for when using raw data, which does not have pre-assembled tiles available)
-                tile_gen_dir = self.data_dir
-                tile_gen_mode = 'stack'
-                if src == CH_SRC_RAW:
-                    if not raw_dir:
-                        raise ValueError('When extracting raw data channels, the `raw_dir` argument must be provided')
-                    tile_gen_dir = raw_dir
-                    tile_gen_mode = 'raw'
-                generator = tile_generator.CytokitTileGenerator(
-                    self.config, tile_gen_dir, loc.region_index, loc.tile_index,
-                    mode=tile_gen_mode, path_fmt_name=PATH_FMT_MAP[src]
-                )
-                tile = generator.run(None)
-
-                # Crop raw images if necessary
-                if src == CH_SRC_RAW:
-                    tile = tile_crop.CytokitTileCrop(self.config).run(tile)
-
-                # Sort channels by name to make extract channel order deterministic
-                for _, r in channel_map.get_group(src).sort_values('channel_name').iterrows():
-
-                    # Extract (z, h, w) subtile
-                    sub_tile = tile[r['cycle_index'], z_slice, r['channel_index']]
-                    logging.debug(
-                        'Extraction for cycle %s, channel %s (%s), z slice %s, source "%s" complete (tile shape = %s)',
-                        r['cycle_index'], r['channel_index'], r['channel_name'], z_slice, src, sub_tile.shape
-                    )
-                    assert sub_tile.ndim == 3, \
-                        'Expecting sub_tile to have 3 dimensions but got shape {}'.format(sub_tile.shape)
-                    slice_labels.append('{}_{}'.format(src, r['channel_name']))
-                    extract_tile.append(sub_tile)
-
-            # Stack the subtiles to give array with shape (z, channels, h, w) and then reshape to 5D
-            # format like (cycles, z, channels, h, w)
-            extract_tile = np.stack(extract_tile, axis=1)[np.newaxis]
-            assert extract_tile.ndim == 5, \
-                'Expecting extract tile to have 5 dimensions but got shape {}'.format(extract_tile.shape)
-
-            extract_path = cytokit_io.get_extract_image_path(loc.region_index, loc.tile_x, loc.tile_y, name)
-            extract_path = osp.join(self.data_dir, extract_path)
-            logging.debug(
-                'Saving tile with shape %s (dtype = %s) to "%s"',
-                extract_tile.shape, extract_tile.dtype, extract_path
+        n_tiles = len(tile_locations)
+        if n_workers is None:
+            n_workers = min(MAX_EXTRACT_WORKERS, n_tiles)
+        n_workers = max(int(n_workers), 1)
+
+        # Resolve cropping for raw images once for all tiles, if necessary (this uses stateless functions
+        # rather than a shared CytokitTileCrop op, whose run method is not safe to call concurrently)
+        crop_slice = tile_crop.get_slice(self.config) if CH_SRC_RAW in channel_map else None
+
+        # Resolve result paths using a single path format for all tiles and create the directories
+        # containing them once here rather than checking for them as each tile is saved
+        path_fn = cytokit_io.get_extract_image_path_fn(name)
+        extract_paths = [
+            osp.join(self.data_dir, path_fn(loc.region_index, loc.tile_x, loc.tile_y))
+            for loc in tile_locations
+        ]
+        for extract_dir in set(osp.dirname(path) for path in extract_paths):
+            os.makedirs(extract_dir, exist_ok=True)
+
+        # Ignore known tifffile read warnings for the whole process before tiles are dispatched, since the
+        # per-read warning filter context is not safe to use from concurrent workers
+        cytokit_io.set_tiff_warning_filters()
+
+        lock = threading.Lock()
+        n_complete = 0
+
+        def process_tile(loc, extract_path):
+            nonlocal n_complete
+            self._extract_tile(
+                loc, extract_path, channel_map, channel_sources, z_slice_fn, raw_dir,
+                crop_slice=crop_slice, dtype=dtype
             )
+            with lock:
+                n_complete += 1
+                logging.info('Extracted tile %s of %s', n_complete, n_tiles)
 
-            # Construct slice labels as repeats across z-dimension (there is only one time/cycle dimension)
-            slice_label_tags = ij_utils.get_channel_label_tags(slice_labels, z=extract_tile.shape[1], t=1)
-            cytokit_io.save_tile(
-                extract_path, extract_tile, config=self.config,
-                infer_labels=False, extratags=slice_label_tags
-            )
+        if scheduler is None:
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(process_tile, tile_locations, extract_paths))
+        else:
+            import dask
+            logging.info('Extracting %s tiles using dask scheduler "%s"', n_tiles, scheduler)
+            tasks = [
+                dask.delayed(self._extract_tile)(
+                    loc, extract_path, channel_map, channel_sources, z_slice_fn, raw_dir,
+                    crop_slice=crop_slice, dtype=dtype
+                )
+                for loc, extract_path in zip(tile_locations, extract_paths)
+            ]
+            dask.compute(*tasks, scheduler=scheduler, num_workers=n_workers)
 
+        extract_path = extract_paths[-1] if extract_paths else None
         logging.info('Extraction complete (results saved to %s)', osp.dirname(extract_path) if extract_path else None)
 
     def montage(self, name, extract_name, region_indexes=None, crop=None):
@@ -138,14 +138,26 @@ class Config(object):
         Returns:
             (cycle, channel) - 0-based indexes for cycle and channel
         """
-        cnames = [c.lower() for c in self.channel_names]
+        coord_map = self.get_channel_coordinates_map()
         cname = channel_name.lower()
-        if cname not in cnames:
+        if cname not in coord_map:
             raise ValueError('Channel "{}" is not configured channel list {}'.format(channel_name, self.channel_names))
-        i = cnames.index(cname)
-        cycle_index = i // self.n_channels_per_cycle
-        ch_index = i % self.n_channels_per_cycle
-        return cycle_index, ch_index
+        return coord_map[cname]
+
+    def get_channel_coordinates_map(self):
+        """Get 0-based cycle and per-cycle-channel index coordinates for all channels
+
+        This is preferable to `get_channel_coordinates` when resolving many channels at once.
+
+        Returns:
+            Dictionary mapping lower case channel name to (cycle, channel) - 0-based indexes for cycle and
+            channel; if a name occurs more than once, only the first occurrence is included
+        """
+        nch = self.n_channels_per_cycle
+        res = {}
+        for i, cname in enumerate(self.channel_names):
+            res.setdefault(cname.lower(), (i // nch, i % nch))
+        return res
 
 
 class CytokitConfigV10(Config):
@@ -14,12 +14,13 @@ References:
 import os
 import cytokit
 import warnings
+import contextlib
 import os.path as osp
 import numpy as np
 import cytokit
 from cytokit.utils import ij_utils
 from skimage import io as sk_io
-from tifffile import imread, imsave, TiffFile
+from tifffile import imread, imsave, memmap, TiffFile
 
 
 def _to_pd_sep(format):
@@ -56,12 +57,14 @@ def _formats():
     return eval(formats)
 
 
-def save_image(file, image, imagej=True, **kwargs):
+def save_image(file, image, imagej=True, skip_mkdir=False, **kwargs):
     """Save tif image (with default to ImageJ format)
 
     Args:
         file: File path to save to; will overwrite if exists and will also create directory if not present
         image: Image array to save
+        skip_mkdir: If true, the directory containing `file` is assumed to exist and will not be checked for
+            (useful when saving many files to the same directory)
         kwargs: Anything compatible with tifffile.imsave (see
             https://github.com/blink1073/tifffile/blob/master/tifffile/tifffile.py)
     Examples:
@@ -76,7 +79,7 @@ def save_image(file, image, imagej=True, **kwargs):
                 metadata={'spacing': 3.947368, 'unit': 'um'}
             )
     """
-    if not osp.exists(osp.dirname(file)):
+    if not skip_mkdir and not osp.exists(osp.dirname(file)):
         os.makedirs(osp.dirname(file), exist_ok=True)
     imsave(file, image, imagej=imagej, **kwargs)
 
@@ -100,9 +103,34 @@ def _set_tiff_warning_filters():
     )
 
 
+# Flag indicating whether or not tifffile warning filters have been installed process-wide
+_tiff_warning_filters_set = False
+
+
+def set_tiff_warning_filters():
+    """Install filters for warnings known to occur when reading tiff files for the whole process
+
+    Once set, reads no longer save and restore the warning filter list around each file (via
+    `warnings.catch_warnings`), which is not thread-safe; this should be called before reading
+    files from multiple threads
+    """
+    global _tiff_warning_filters_set
+    _set_tiff_warning_filters()
+    _tiff_warning_filters_set = True
+
+
+@contextlib.contextmanager
+def _tiff_warning_context():
+    if _tiff_warning_filters_set:
+        yield
+    else:
+        with warnings.catch_warnings():
+            _set_tiff_warning_filters()
+            yield
+
+
 def read_image(file, return_metadata=False):
-    with warnings.catch_warnings():
-        _set_tiff_warning_filters()
+    with _tiff_warning_context():
 
         # Use skimage io if metadata not necessary
         if not return_metadata:
@@ -126,8 +154,7 @@ def read_tile(file, return_metadata=False):
     # {'ImageJ': '1.11a', 'axes': 'TZCYX', 'channels': 2, 'frames': 2, 'hyperstack': True,
     # 'images': 100, 'mode': 'grayscale', 'slices': 25}
     # However, if a unit-length dimension was dropped it simply does not show up in this dict
-    with warnings.catch_warnings():
-        _set_tiff_warning_filters()
+    with _tiff_warning_context():
         with TiffFile(file) as tif:
             tags = dict(tif.imagej_metadata)
             if 'axes' not in tags:
@@ -181,10 +208,17 @@ def _get_tif_metadata(tif, shape=None):
     return res
 
 
-def save_tile(file, tile, config=None, infer_labels=True, **kwargs):
-    """Save a cytokit-specific 5D image"""
-    if tile.ndim != 5:
-        raise ValueError('Expecting tile with 5 dimensions but got tile with shape {}'.format(tile.shape))
+# Tiles of at least this many bytes are saved with compression by default
+TILE_COMPRESSION_MIN_BYTES = 2 ** 24
+# Deflate level used when compressing tiles by default (level 1 is several times faster to encode
+# than higher levels while giving a comparable ratio for microscopy images)
+TILE_COMPRESSION_LEVEL = 1
+
+
+def _get_tile_kwargs(shape, config=None, infer_labels=True, **kwargs):
+    """Get tifffile arguments necessary to save a cytokit-specific 5D image with the given shape"""
+    if len(shape) != 5:
+        raise ValueError('Expecting tile with 5 dimensions but got tile with shape {}'.format(shape))
     # Save with explicit axes settings otherwise channels, cycles, and z planes are
     # all interpreted as individual slices instead of separate dimensions
     if 'metadata' not in kwargs:
@@ -202,13 +236,50 @@ def save_tile(file, tile, config=None, infer_labels=True, **kwargs):
 
         # If enabled, attempt to infer and add slice names
         if infer_labels:
-            tags = ij_utils.get_config_slice_label_args(config, tile.shape)
+            tags = ij_utils.get_config_slice_label_args(config, shape)
             if tags is not None:
                 if 'extratags' not in kwargs:
                     kwargs['extratags'] = []
                 kwargs['extratags'] += tags
+    return kwargs
+
+
+def save_tile(file, tile, config=None, infer_labels=True, compress=None, skip_mkdir=False, **kwargs):
+    """Save a cytokit-specific 5D image
+
+    Args:
+        skip_mkdir: If true, the directory containing `file` is assumed to exist (see `save_image`)
+        compress: Deflate (zlib) compression level from 0 to 9 where 0 means no compression; if not set, tiles
+            with at least TILE_COMPRESSION_MIN_BYTES bytes are compressed with level TILE_COMPRESSION_LEVEL and
+            smaller tiles are saved uncompressed
+    """
+    if compress is None:
+        compress = TILE_COMPRESSION_LEVEL if tile.nbytes >= TILE_COMPRESSION_MIN_BYTES else 0
+    kwargs = _get_tile_kwargs(tile.shape, config=config, infer_labels=infer_labels, **kwargs)
+    save_image(file, tile, compress=compress, skip_mkdir=skip_mkdir, **kwargs)
+
+
+def create_tile_memmap(file, shape, dtype, config=None, infer_labels=True, skip_mkdir=False, **kwargs):
+    """Create a cytokit-specific 5D image file and return a writable, memory-mapped array backed by it
 
-    save_image(file, tile, **kwargs)
+    This is useful for assembling tiles in place on disk rather than building them in memory first.  Contents
+    of the returned array are undefined until written and `flush` should be called on it once complete.
+
+    Args:
+        file: File path to create; will overwrite if exists and will also create directory if not present
+        shape: 5D shape of tile
+        dtype: Data type of tile
+        config: Experiment configuration used to add resolution and label metadata (same as `save_tile`)
+        infer_labels: Whether or not to infer slice labels from `config` (same as `save_tile`)
+        skip_mkdir: If true, the directory containing `file` is assumed to exist (see `save_image`)
+        kwargs: Anything compatible with tifffile.imsave not related to image data or compression
+    Returns:
+        numpy.memmap with given shape and type
+    """
+    kwargs = _get_tile_kwargs(shape, config=config, infer_labels=infer_labels, **kwargs)
+    if not skip_mkdir and not osp.exists(osp.dirname(file)):
+        os.makedirs(osp.dirname(file), exist_ok=True)
+    return memmap(file, shape=shape, dtype=dtype, imagej=True, **kwargs)
 
 
 def get_raw_img_path(ireg, itile, icyc, ich, iz):
@@ -259,6 +330,18 @@ def get_extract_image_path(ireg, tx, ty, name):
     return _formats()[FMT_EXTRACT_IMAGE].format(region=ireg + 1, x=tx + 1, y=ty + 1, name=name)
 
 
+def get_extract_image_path_fn(name):
+    """Get function equivalent to `get_extract_image_path` for a single extraction
+
+    This is useful for generating many paths without re-resolving path formats each time.
+
+    Returns:
+        A function with signature (ireg, tx, ty) -> path
+    """
+    fmt = _formats()[FMT_EXTRACT_IMAGE]
+    return lambda ireg, tx, ty: fmt.format(region=ireg + 1, x=tx + 1, y=ty + 1, name=name)
+
+
 def get_montage_image_path(ireg, name):
     return _formats()[FMT_MONTAGE_IMAGE].format(region=ireg + 1, name=name)
 
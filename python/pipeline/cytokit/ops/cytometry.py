@@ -32,6 +32,11 @@ def get_channel_coordinates(channel):
     return CHANNEL_COORDINATES[channel]
 
 
+def get_channel_coordinates_map():
+    """Get map of lower case cytometry channel name to (cycle, channel) coordinates"""
+    return dict(CHANNEL_COORDINATES)
+
+
 def set_keras_session(op):
     import keras.backend.tensorflow_backend as KTF
     import tensorflow as tf
@@ -26,27 +26,44 @@ def apply_slice(img, crop_slice):
     return img[slices]
 
 
+def crop(tile, config, crop_slice=None):
+    """Crop trailing image dimensions of a tile to the target tile size in a configuration
+
+    This is a stateless equivalent of `CytokitTileCrop.run` and unlike it, is safe to call concurrently.
+
+    Args:
+        tile: Image array with at least 2 dimensions where the last two are height and width
+        config: Experiment configuration
+        crop_slice: Result of `get_slice(config)` if already computed; computed here otherwise
+    Returns:
+        Cropped tile (as a view of the original) or the original tile if its image dimensions are
+        not larger than the configured tile size (a warning is logged in this case)
+    """
+    # Check to see if tile dimensions indicate that cropping is not possible and return immediately if so
+    ih, iw = tile.shape[-2:]
+    nh, nw = config.tile_height, config.tile_width
+    if iw <= nw or ih <= nh:
+        logger.warning(
+            'Tile cropping is attempting to run on a tile of shape {} but the configured '
+            'target height and width {} already exceeds or equals the size of the provided tile '
+            'in the image dimensions.  The tile will be returned as-is but this could indicate '
+            'an issue and if not, tile crop should be disabled'
+            .format(tile.shape, (nh, nw))
+        )
+        return tile
+
+    # Otherwise, run the cropping operation
+    return apply_slice(tile, crop_slice if crop_slice is not None else get_slice(config))
+
+
 class CytokitTileCrop(CytokitOp):
 
     def __init__(self, config):
         super().__init__(config)
 
     def _run(self, tile, **kwargs):
-
-        # Check to see if tile dimensions indicate that cropping is not possible and return immediately if so
-        ih, iw = tile.shape[-2:]
-        nh, nw = self.config.tile_height, self.config.tile_width
-        if iw <= nw or ih <= nh:
-            logger.warning(
-                'Tile cropping is attempting to run on a tile of shape {} but the configured '
-                'target height and width {} already exceeds or equals the size of the provided tile '
-                'in the image dimensions.  The tile will be returned as-is but this could indicate '
-                'an issue and if not, tile crop should be disabled'
-                .format(tile.shape, (nh, nw))
-            )
-            return tile
-
-        # Otherwise, run the cropping operation
         slice_arr = get_slice(self.config)
-        self.record({'slice': [str(v) for v in slice_arr]})
-        return apply_slice(tile, slice_arr)
\ No newline at end of file
+        res = crop(tile, self.config, slice_arr)
+        if res is not tile:
+            self.record({'slice': [str(v) for v in slice_arr]})
+        return res
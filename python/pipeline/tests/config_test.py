@@ -39,5 +39,11 @@ class TestConfig(unittest.TestCase):
         self.assertAlmostEqual(point_coord[0], conf.tile_width - .01, 3)
         self.assertAlmostEqual(point_coord[1], conf.tile_height - .01, 3)
 
+    def test_get_channel_coordinates_map(self):
+        conf = self._get_example_conf()
 
-
+        # Map should be consistent with single channel lookups (and ignore case)
+        coord_map = conf.get_channel_coordinates_map()
+        self.assertEqual(len(coord_map), len(set([c.lower() for c in conf.channel_names])))
+        for channel in conf.channel_names:
+            self.assertEqual(coord_map[channel.lower()], conf.get_channel_coordinates(channel.upper()))
@@ -0,0 +1,57 @@
+import unittest
+import tempfile
+import os.path as osp
+import numpy as np
+import cytokit
+from cytokit import io as cytokit_io
+from cytokit.utils import ij_utils
+from numpy.testing import assert_array_equal
+
+
+class TestIo(unittest.TestCase):
+
+    def test_tile_memmap_round_trip(self):
+        out_dir = tempfile.mkdtemp(prefix='cytokit_test_io_')
+        path = osp.join(out_dir, 'tile.tif')
+
+        # Create tile as (cycles, z, channels, h, w) with labels repeated across z planes
+        shape, labels = (1, 2, 3, 4, 5), ['ch1', 'ch2', 'ch3']
+        tags = ij_utils.get_channel_label_tags(labels, z=shape[1], t=1)
+        tile = cytokit_io.create_tile_memmap(path, shape, np.uint16, infer_labels=False, extratags=tags)
+        self.assertEqual(tile.shape, shape)
+
+        expected = np.arange(np.prod(shape), dtype=np.uint16).reshape(shape)
+        tile[:] = expected
+        tile.flush()
+        del tile
+
+        img, meta = cytokit_io.read_tile(path, return_metadata=True)
+        self.assertEqual(img.shape, shape)
+        self.assertEqual(img.dtype, np.uint16)
+        assert_array_equal(img, expected)
+        self.assertEqual(list(meta['labels']), labels * shape[1])
+
+    def test_extract_image_path_fn(self):
+        # Paths from the single-extraction function should match those from `get_extract_image_path`,
+        # including for names containing braces and for configured formats with conversions or format
+        # specs on the name field
+        default_formats = cytokit.get_path_formats()
+        try:
+            cases = [
+                (None, None),
+                ('extract/{name!s}/R{region:03d}.tif', 'extract/ex/R002.tif'),
+                ('extract/{name:s}/{{name}}/R{region:03d}.tif', 'extract/ex/{name}/R002.tif')
+            ]
+            for extract_fmt, extract_path in cases:
+                if extract_fmt is not None:
+                    formats = dict(cytokit_io.PATH_FORMATS[default_formats])
+                    formats[cytokit_io.FMT_EXTRACT_IMAGE] = extract_fmt
+                    cytokit.set_path_formats(repr(formats))
+                    self.assertEqual(cytokit_io.get_extract_image_path_fn('ex')(1, 2, 3), extract_path)
+                fmt = cytokit_io._formats()[cytokit_io.FMT_EXTRACT_IMAGE]
+                for name in ['extract', 'extract_{x}', '{name}', 'ext}{ract']:
+                    expected = fmt.format(region=2, x=3, y=4, name=name)
+                    self.assertEqual(cytokit_io.get_extract_image_path(ireg=1, tx=2, ty=3, name=name), expected)
+                    self.assertEqual(cytokit_io.get_extract_image_path_fn(name)(1, 2, 3), expected)
+        finally:
+            cytokit.set_path_formats(default_formats)